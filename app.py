@@ -1,103 +1,443 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, session
+from flask import Flask, render_template, stream_template, request, redirect, url_for, flash, session, g, has_request_context, make_response, get_flashed_messages
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.pagination import Pagination
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
-from werkzeug.security import generate_password_hash, check_password_hash
+from flask_caching import Cache
+from flask_session import Session
+from flask_limiter import Limiter
+from flask_limiter.util import get_remote_address
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerifyMismatchError
+from sqlalchemy import delete, event, func, inspect, literal_column, text, tuple_, update
+from sqlalchemy.dialects import postgresql, sqlite  # postgresql import also registers the tsvector functions
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import make_transient_to_detached, selectinload
+from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.security import check_password_hash
+from jinja2 import FileSystemBytecodeCache
 from datetime import datetime
+from types import SimpleNamespace
+import hashlib
+import math
 import os
+import redis
+import sqlite3
+import uuid
 
 app = Flask(__name__)
+# Only trust X-Forwarded-For when deployed behind that many proxies (render.yaml sets 1); otherwise any
+# client could pick its own address and dodge the login rate limit
+proxy_fix_x_for = int(os.environ.get('PROXY_FIX_X_FOR') or 0)
+if proxy_fix_x_for:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=proxy_fix_x_for)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'dev-secret-key-change-in-prod')
 app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///ecommerce.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+if not app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'pool_size': 20,
+        'max_overflow': 40,
+        'pool_pre_ping': True,
+        'pool_recycle': 1800,
+    }
+app.config['QUERY_COUNT_HEADER'] = os.environ.get('QUERY_COUNT_HEADER') == '1'
+app.config['REDIS_URL'] = os.environ.get('REDIS_URL')
+app.config['CACHE_TYPE'] = 'RedisCache' if app.config['REDIS_URL'] else 'SimpleCache'
+app.config['CACHE_REDIS_URL'] = app.config['REDIS_URL']
+if app.config['REDIS_URL']:
+    app.config['SESSION_TYPE'] = 'redis'
+    app.config['SESSION_REDIS'] = redis.from_url(app.config['REDIS_URL'])
+    Session(app)
 db = SQLAlchemy(app)
+cache = Cache(app)
+# Compiled templates are shared across worker restarts instead of being recompiled by each process
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache()
 login_manager = LoginManager(app)
 login_manager.login_view = 'login'
+limiter = Limiter(get_remote_address, app=app, storage_uri=app.config['REDIS_URL'] or 'memory://')
+password_hasher = PasswordHasher(time_cost=2, memory_cost=65536, parallelism=1)
+
+@event.listens_for(Engine, 'connect')
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL lets readers run alongside checkout writes; NORMAL syncs at checkpoints instead of every commit
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute('PRAGMA cache_size=-64000')
+        cursor.close()
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def count_query(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context():
+        g.query_count = g.get('query_count', 0) + 1
+
+@app.after_request
+def add_query_count_header(response):
+    # Surfaces N+1 regressions during development without a profiler
+    if app.debug or app.config['QUERY_COUNT_HEADER']:
+        response.headers['X-Query-Count'] = str(g.get('query_count', 0))
+    return response
 
 # Models
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    email = db.Column(db.String(150), unique=True)
-    password = db.Column(db.String(150))
+    email = db.Column(db.String(150), unique=True, index=True)
+    password = db.Column(db.String(255))
     name = db.Column(db.String(150))
     address = db.Column(db.Text)
-    orders = db.relationship('Order', backref='user', lazy=True)
-    cart_items = db.relationship('CartItem', backref='user', lazy=True)
+    orders = db.relationship('Order', back_populates='user', lazy='select')
+    cart_items = db.relationship('CartItem', back_populates='user', lazy='select')
 
 class Category(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100))
-    products = db.relationship('Product', backref='category', lazy=True)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
+    products = db.relationship('Product', back_populates='category', lazy='select')
 
 class Product(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(200))
+    name = db.Column(db.String(200), index=True)
     description = db.Column(db.Text)
-    price = db.Column(db.Float)
+    price = db.Column(db.Float, index=True)
     image = db.Column(db.String(200))
-    category_id = db.Column(db.Integer, db.ForeignKey('category.id'))
+    category_id = db.Column(db.Integer, db.ForeignKey('category.id'), index=True)
     stock = db.Column(db.Integer, default=10)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
+    category = db.relationship('Category', back_populates='products')
+
+    __table_args__ = (
+        db.Index('ix_product_name_tsv', func.to_tsvector(literal_column("'english'"), name), postgresql_using='gin')
+        .ddl_if(dialect='postgresql'),
+    )
+
+# SQLite full-text index over product names, kept in sync with the product table by triggers
+PRODUCT_FTS_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS product_fts USING fts5(name, content='product', content_rowid='id')",
+    "CREATE TRIGGER IF NOT EXISTS product_fts_ai AFTER INSERT ON product BEGIN "
+    "INSERT INTO product_fts(rowid, name) VALUES (new.id, new.name); END",
+    "CREATE TRIGGER IF NOT EXISTS product_fts_ad AFTER DELETE ON product BEGIN "
+    "INSERT INTO product_fts(product_fts, rowid, name) VALUES ('delete', old.id, old.name); END",
+    "CREATE TRIGGER IF NOT EXISTS product_fts_au AFTER UPDATE OF name ON product BEGIN "
+    "INSERT INTO product_fts(product_fts, rowid, name) VALUES ('delete', old.id, old.name); "
+    "INSERT INTO product_fts(rowid, name) VALUES (new.id, new.name); END",
+]
+
+def ensure_product_fts(connection):
+    existed = inspect(connection).has_table('product_fts')
+    for stmt in PRODUCT_FTS_DDL:
+        connection.exec_driver_sql(stmt)
+    if not existed:
+        # Index products that were inserted before the triggers existed
+        connection.exec_driver_sql("INSERT INTO product_fts(product_fts) VALUES ('rebuild')")
+
+@event.listens_for(Product.__table__, 'after_create')
+def create_product_fts(target, connection, **kw):
+    if connection.dialect.name == 'sqlite':
+        ensure_product_fts(connection)
+
+@event.listens_for(Product.__table__, 'after_drop')
+def drop_product_fts(target, connection, **kw):
+    if connection.dialect.name == 'sqlite':
+        connection.exec_driver_sql('DROP TABLE IF EXISTS product_fts')
 
 class Order(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
     total = db.Column(db.Float)
-    date = db.Column(db.DateTime, default=datetime.utcnow)
-    items = db.relationship('OrderItem', backref='order', lazy=True)
+    # default= renders now() into the INSERT too, for databases whose column predates the server default
+    date = db.Column(db.DateTime(timezone=True), default=func.now(), server_default=func.now(), index=True)
+    user = db.relationship('User', back_populates='orders')
+    items = db.relationship('OrderItem', back_populates='order', lazy='select')
 
 class OrderItem(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    order_id = db.Column(db.Integer, db.ForeignKey('order.id'))
+    order_id = db.Column(db.Integer, db.ForeignKey('order.id'), index=True)
     product_id = db.Column(db.Integer, db.ForeignKey('product.id'))
     quantity = db.Column(db.Integer)
     price = db.Column(db.Float)
 
+    order = db.relationship('Order', back_populates='items')
     product = db.relationship('Product')
 
 class CartItem(db.Model):
+    # One row per product per user; the constraint's index also serves lookups by user_id alone
+    __table_args__ = (db.UniqueConstraint('user_id', 'product_id', name='uq_cart_user_product'),)
+
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
-    product_id = db.Column(db.Integer, db.ForeignKey('product.id'))
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), index=True)
     quantity = db.Column(db.Integer)
-    product = db.relationship('Product', backref='cart_items')
+    user = db.relationship('User', back_populates='cart_items')
+    product = db.relationship('Product')
+
+USER_CACHE_FIELDS = ('id', 'email', 'name', 'address')
+
+def upgrade_schema():
+    # There are no migrations; bring databases created by earlier versions of the app up to date
+    with db.engine.begin() as connection:
+        tables = inspect(connection).get_table_names()
+        if connection.dialect.name == 'sqlite' and 'product' in tables:
+            ensure_product_fts(connection)
+        if 'cart_item' in tables:
+            ensure_cart_item_unique(connection)
+        for model in (Product, Category):
+            if model.__tablename__ in tables:
+                ensure_updated_at(connection, model.__table__)
+        if 'order' in tables:
+            # Orders placed before the date default reached the INSERT were stored without one
+            connection.execute(update(Order).where(Order.date.is_(None)).values(date=func.now()))
+        # Runs last so indexes on columns added above (updated_at) can be built
+        for table in db.metadata.sorted_tables:
+            if table.name in tables:
+                for index in table.indexes:
+                    index.create(connection, checkfirst=True)
+
+def ensure_updated_at(connection, table):
+    if 'updated_at' in {column['name'] for column in inspect(connection).get_columns(table.name)}:
+        return
+    column_type = table.c.updated_at.type.compile(dialect=connection.dialect)
+    connection.exec_driver_sql(f'ALTER TABLE {table.name} ADD COLUMN updated_at {column_type}')
+    connection.execute(table.update().values(updated_at=datetime.utcnow()))
+
+def ensure_cart_item_unique(connection):
+    # add_cart_item's ON CONFLICT needs a unique index on (user_id, product_id)
+    inspector = inspect(connection)
+    columns = ['user_id', 'product_id']
+    if any(uc['column_names'] == columns for uc in inspector.get_unique_constraints('cart_item')) or \
+            any(ix['unique'] and ix['column_names'] == columns for ix in inspector.get_indexes('cart_item')):
+        return
+    # Fold duplicate rows into the oldest one before the index can be created
+    duplicates = connection.execute(
+        db.select(CartItem.user_id, CartItem.product_id, func.min(CartItem.id), func.sum(CartItem.quantity))
+        .group_by(CartItem.user_id, CartItem.product_id)
+        .having(func.count() > 1)
+    ).all()
+    for user_id, product_id, keep_id, quantity in duplicates:
+        connection.execute(update(CartItem).where(CartItem.id == keep_id).values(quantity=min(quantity, 100)))
+        connection.execute(delete(CartItem).where(CartItem.user_id == user_id, CartItem.product_id == product_id,
+                                                  CartItem.id != keep_id))
+    connection.exec_driver_sql(
+        'CREATE UNIQUE INDEX IF NOT EXISTS uq_cart_user_product ON cart_item (user_id, product_id)')
+
+with app.app_context():
+    upgrade_schema()
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
-
-# Routes
-@app.route('/')
-def home():
-    page = request.args.get('page', 1, type=int)
-    search = request.args.get('search')
-    category_id = request.args.get('category')
-    sort = request.args.get('sort', 'name')
-
-    query = Product.query.join(Category)
-
-    if search:
-        query = query.filter(Product.name.contains(search))
+    key = f'user:{int(user_id)}'
+    data = cache.get(key)
+    if data is None:
+        user = User.query.get(int(user_id))
+        if user:
+            cache.set(key, {field: getattr(user, field) for field in USER_CACHE_FIELDS}, timeout=300)
+        return user
+    # Attach the cached row to the session without a SELECT so profile edits still persist
+    user = User(**data)
+    make_transient_to_detached(user)
+    return db.session.merge(user, load=False)
+
+def get_cart_items(user_id):
+    # Load products in one IN query instead of one lazy SELECT per cart row
+    stmt = db.select(CartItem).where(CartItem.user_id == user_id).options(selectinload(CartItem.product))
+    return db.session.execute(stmt).scalars().all()
+
+def add_cart_item(user_id, product_id):
+    dialect = db.engine.dialect.name
+    if dialect in ('postgresql', 'sqlite'):
+        # Single INSERT ... ON CONFLICT DO UPDATE, so double clicks can't create duplicate rows
+        insert = postgresql.insert if dialect == 'postgresql' else sqlite.insert
+        capped = func.least if dialect == 'postgresql' else func.min
+        stmt = insert(CartItem).values(user_id=user_id, product_id=product_id, quantity=1)
+        stmt = stmt.on_conflict_do_update(index_elements=['user_id', 'product_id'],
+                                          set_={'quantity': capped(CartItem.quantity + 1, 100)})
+        db.session.execute(stmt)
+        return
+    cart_item = CartItem.query.filter_by(user_id=user_id, product_id=product_id).first()
+    if cart_item:
+        cart_item.quantity = min(cart_item.quantity + 1, 100)
+    else:
+        db.session.add(CartItem(user_id=user_id, product_id=product_id, quantity=1))
+
+def product_search_filter(search):
+    dialect = db.engine.dialect.name
+    if dialect == 'postgresql':
+        # Literal config (not a bound parameter) so the expression matches ix_product_name_tsv
+        config = literal_column("'english'")
+        return func.to_tsvector(config, Product.name).op('@@')(func.plainto_tsquery(config, search))
+    if dialect == 'sqlite':
+        # Quote each word so user input can't inject FTS5 syntax; trailing * makes it a prefix match
+        terms = ' '.join('"%s"*' % word.replace('"', '""') for word in search.split())
+        return Product.id.in_(text('SELECT rowid FROM product_fts WHERE product_fts MATCH :q').bindparams(q=terms))
+    return Product.name.contains(search)
+
+def get_cart_total(user_id):
+    stmt = (db.select(func.coalesce(func.sum(Product.price * CartItem.quantity), 0))
+            .select_from(CartItem)
+            .join(Product, Product.id == CartItem.product_id)
+            .where(CartItem.user_id == user_id))
+    return db.session.execute(stmt).scalar()
+
+def verify_password(user, password):
+    try:
+        if user.password.startswith('$argon2'):
+            password_hasher.verify(user.password, password)
+        elif not check_password_hash(user.password, password):
+            return False
+    except (VerifyMismatchError, InvalidHashError):
+        return False
+    # Upgrade legacy werkzeug hashes and argon2 hashes made with older parameters
+    if not user.password.startswith('$argon2') or password_hasher.check_needs_rehash(user.password):
+        user.password = password_hasher.hash(password)
+        db.session.commit()
+    return True
+
+def get_product_cached(product_id):
+    key = f'product:{product_id}'
+    data = cache.get(key)
+    if data is None:
+        prod = Product.query.options(selectinload(Product.category)).get_or_404(product_id)
+        category = {'name': prod.category.name, 'updated_at': prod.category.updated_at} if prod.category else None
+        data = {'id': prod.id, 'name': prod.name, 'description': prod.description, 'price': prod.price,
+                'image': prod.image, 'stock': prod.stock, 'updated_at': prod.updated_at, 'category': category}
+        cache.set(key, data, timeout=3600)
+    return data
+
+@cache.memoize(timeout=60)
+def get_catalog_version():
+    # Changes whenever a product or category is added or modified. The listing helpers take it as
+    # an argument, so their cache keys (and the page ETag) move together when it changes.
+    stmt = db.select(
+        db.select(func.max(Product.updated_at)).scalar_subquery(),
+        db.select(func.max(Category.updated_at)).scalar_subquery(),
+        db.select(func.count(Product.id)).scalar_subquery(),
+    )
+    return tuple(db.session.execute(stmt).one())
+
+def conditional_page(version, render):
+    # Pages carrying flash messages are one-off and must not be cached
+    if session.get('_flashes'):
+        return render()
+    etag = hashlib.md5(f'{version}|{request.full_path}|{current_user.get_id()}'.encode()).hexdigest()
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        response = make_response(render())
+    response.set_etag(etag)
+    if current_user.is_authenticated:
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+    else:
+        response.cache_control.public = True
+        response.cache_control.max_age = 60
+        response.cache_control.stale_while_revalidate = 300
+    return response
+
+# Catalog data is cached as plain dicts so cached values never hold detached ORM objects
+@cache.memoize(timeout=300)
+def get_categories(catalog_version):
+    # Product counts are aggregated once here and served from cache with the category list
+    stmt = (db.select(Category.id, Category.name, func.count(Product.id))
+            .outerjoin(Product)
+            .group_by(Category.id, Category.name)
+            .order_by(Category.id))
+    return [{'id': cid, 'name': name, 'product_count': count} for cid, name, count in db.session.execute(stmt)]
+
+def filter_product_listing(query, search, category_id):
+    if search and search.strip():
+        query = query.filter(product_search_filter(search))
     if category_id:
         try:
             cid = int(category_id)
             query = query.filter(Product.category_id == cid)
         except ValueError:
             pass
-
+    return query
+
+@cache.memoize(timeout=60)
+def count_product_listing(catalog_version, search, category_id):
+    # Keyed without the page or keyset position, so every page of a listing shares one COUNT
+    return filter_product_listing(Product.query.join(Category), search, category_id).count()
+
+@cache.memoize(timeout=60)
+def get_product_page(catalog_version, page, search, category_id, sort, after_value=None, after_id=None):
+    per_page = 6
+    # Select just the grid columns; 101 chars of description are enough to render the 100-char teaser
+    query = Product.query.join(Category).with_entities(
+        Product.id, Product.name, func.substr(Product.description, 1, 101).label('description'),
+        Product.price, Product.image,
+    )
+    query = filter_product_listing(query, search, category_id)
+
+    # id breaks ties so every row has a unique position for keyset pagination
     if sort == 'price_low':
-        query = query.order_by(Product.price.asc())
+        sort_key, descending = Product.price, False
     elif sort == 'price_high':
-        query = query.order_by(Product.price.desc())
+        sort_key, descending = Product.price, True
+    else:
+        sort_key, descending = Product.name, False
+    if descending:
+        query = query.order_by(sort_key.desc(), Product.id.desc())
     else:
-        query = query.order_by(Product.name.asc())
+        query = query.order_by(sort_key.asc(), Product.id.asc())
 
-    products = query.paginate(page=page, per_page=6, error_out=False)
-    categories = Category.query.all()
-    return render_template('home.html', products=products, categories=categories)
+    keyset = after_value is not None and after_id is not None
+    if keyset and sort_key is Product.price:
+        try:
+            after_value = float(after_value)
+        except ValueError:
+            keyset = False
+
+    if keyset:
+        # Keyset pagination: seek past the previous page's last row instead of scanning OFFSET rows.
+        # The shared cached count keeps the numbered pager intact without rescanning per page.
+        total = count_product_listing(catalog_version, search, category_id)
+        boundary = tuple_(sort_key, Product.id)
+        query = query.filter(boundary < (after_value, after_id) if descending else boundary > (after_value, after_id))
+        rows = query.limit(per_page + 1).all()
+        items, has_next = rows[:per_page], len(rows) > per_page
+        # iter_pages() only reads .page and .pages, so reuse it for the same window as offset pages
+        pages = SimpleNamespace(page=page, pages=math.ceil(total / per_page))
+        pagination = dict(page=page, page_numbers=list(Pagination.iter_pages(pages)), has_prev=page > 1,
+                          prev_num=page - 1, has_next=has_next, next_num=page + 1)
+    else:
+        products = query.paginate(page=page, per_page=per_page, error_out=False)
+        items = products.items
+        pagination = dict(page=products.page, page_numbers=list(products.iter_pages()),
+                          has_prev=products.has_prev, prev_num=products.prev_num,
+                          has_next=products.has_next, next_num=products.next_num)
+
+    last = items[-1] if pagination['has_next'] and items else None
+    return SimpleNamespace(
+        items=[{'id': p.id, 'name': p.name, 'description': p.description, 'price': p.price, 'image': p.image}
+               for p in items],
+        next_after=(getattr(last, sort_key.key), last.id) if last else None,
+        **pagination,
+    )
+
+# Routes
+@app.route('/')
+def home():
+    page = request.args.get('page', 1, type=int)
+    search = request.args.get('search')
+    category_id = request.args.get('category')
+    sort = request.args.get('sort', 'name')
+    after_value = request.args.get('after_value')
+    after_id = request.args.get('after_id', type=int)
+
+    version = get_catalog_version()
+
+    def render():
+        products = get_product_page(version, page, search, category_id, sort, after_value, after_id)
+        categories = get_categories(version)
+        return render_template('home.html', products=products, categories=categories)
+    return conditional_page(version, render)
 
 @app.route('/product/<int:id>')
 def product(id):
-    prod = Product.query.get_or_404(id)
-    return render_template('product.html', product=prod)
+    prod = get_product_cached(id)
+    version = (prod['updated_at'], prod['category']['updated_at'] if prod['category'] else None)
+    return conditional_page(version, lambda: render_template('product.html', product=prod))
 
 @app.route('/cart', methods=['GET', 'POST'])
 @login_required
@@ -105,6 +445,7 @@ def cart():
     if request.method == 'POST':
         # Update quantities
         if 'update' in request.form:
+            quantities = {}
             for key, value in request.form.items():
                 if key.startswith('quantity_'):
                     try:
@@ -115,9 +456,12 @@ def cart():
                     # sanitize quantity
                     quantity = max(1, quantity)
                     quantity = min(quantity, 100)  # upper bound
-                    cart_item = CartItem.query.filter_by(user_id=current_user.id, product_id=product_id).first()
-                    if cart_item:
-                        cart_item.quantity = quantity
+                    quantities[product_id] = quantity
+            if quantities:
+                # Fetch all affected rows in one query rather than one per field
+                stmt = db.select(CartItem).where(CartItem.user_id == current_user.id, CartItem.product_id.in_(quantities))
+                for cart_item in db.session.execute(stmt).scalars():
+                    cart_item.quantity = quantities[cart_item.product_id]
             db.session.commit()
         # Remove item
         elif 'remove' in request.form:
@@ -130,20 +474,15 @@ def cart():
             except (ValueError, KeyError):
                 pass
 
-    cart_items = CartItem.query.filter_by(user_id=current_user.id).all()
+    cart_items = get_cart_items(current_user.id)
     total = sum(item.product.price * item.quantity for item in cart_items)
     return render_template('cart.html', cart_items=cart_items, total=total)
 
 @app.route('/add_to_cart/<int:product_id>')
 @login_required
 def add_to_cart(product_id):
-    prod = Product.query.get_or_404(product_id)
-    cart_item = CartItem.query.filter_by(user_id=current_user.id, product_id=product_id).first()
-    if cart_item:
-        cart_item.quantity = min(cart_item.quantity + 1, 100)
-    else:
-        cart_item = CartItem(user_id=current_user.id, product_id=product_id, quantity=1)
-        db.session.add(cart_item)
+    get_product_cached(product_id)  # 404 for unknown products without hitting the database
+    add_cart_item(current_user.id, product_id)
     db.session.commit()
     flash('Added to cart!')
     return redirect(url_for('home'))
@@ -152,59 +491,86 @@ def add_to_cart(product_id):
 @login_required
 def checkout():
     if request.method == 'POST':
-        cart_items = CartItem.query.filter_by(user_id=current_user.id).all()
+        # Each rendered checkout form carries a one-time token; cache.add() only succeeds for the first submit
+        token_key = f"checkout:{current_user.id}:{request.form.get('checkout_token', '')}"
+        if 'checkout_token' not in request.form or not cache.add(token_key, 1, timeout=300):
+            flash('This order has already been submitted.')
+            return redirect(url_for('orders'))
+
+        cart_items = get_cart_items(current_user.id)
         if not cart_items:
             flash('Cart is empty!')
             return redirect(url_for('cart'))
 
-        # Check stock availability first
-        for item in cart_items:
-            if item.product.stock < item.quantity:
+        # Reserve stock with conditional UPDATEs so concurrent checkouts can't oversell.
+        # Going in product_id order makes every checkout take its row locks in the same order (no deadlocks).
+        for item in sorted(cart_items, key=lambda item: item.product_id):
+            result = db.session.execute(
+                update(Product)
+                .where(Product.id == item.product_id, Product.stock >= item.quantity)
+                .values(stock=Product.stock - item.quantity)
+            )
+            if result.rowcount == 0:
+                db.session.rollback()
+                cache.delete(token_key)
                 flash(f'Not enough stock for {item.product.name}. Available: {item.product.stock}')
                 return redirect(url_for('cart'))
 
-        order = Order(user_id=current_user.id, total=sum(item.product.price * item.quantity for item in cart_items))
+        order = Order(user_id=current_user.id, total=get_cart_total(current_user.id))
         db.session.add(order)
         db.session.flush()
 
-        for item in cart_items:
-            order_item = OrderItem(order_id=order.id, product_id=item.product_id, quantity=item.quantity, price=item.product.price)
-            db.session.add(order_item)
-            # decrease stock
-            item.product.stock = max(0, item.product.stock - item.quantity)
-            db.session.delete(item)
+        order_items = [OrderItem(order_id=order.id, product_id=item.product_id, quantity=item.quantity, price=item.product.price)
+                       for item in cart_items]
+        db.session.add_all(order_items)
+        db.session.execute(delete(CartItem).where(CartItem.user_id == current_user.id))
 
         db.session.commit()
+        # Stock changed, so drop the cached product pages
+        cache.delete_many(*(f'product:{item.product_id}' for item in cart_items))
         flash('Order placed successfully!')
         return redirect(url_for('orders'))
 
-    cart_items = CartItem.query.filter_by(user_id=current_user.id).all()
+    cart_items = get_cart_items(current_user.id)
     total = sum(item.product.price * item.quantity for item in cart_items)
-    return render_template('checkout.html', cart_items=cart_items, total=total)
+    return render_template('checkout.html', cart_items=cart_items, total=total, checkout_token=uuid.uuid4().hex)
 
 @app.route('/orders')
 @login_required
 def orders():
-    orders = Order.query.filter_by(user_id=current_user.id).order_by(Order.date.desc()).all()
-    return render_template('orders.html', orders=orders)
+    stmt = (db.select(Order)
+            .where(Order.user_id == current_user.id)
+            .options(selectinload(Order.items).selectinload(OrderItem.product))
+            .order_by(Order.date.desc(), Order.id.desc())
+            .execution_options(yield_per=50))
+
+    def iter_orders():
+        # Runs while the template streams, after the view's own db session has been removed
+        yield from db.session.execute(stmt).scalars()
+
+    # Pop flashes now: a streamed body renders after the session cookie has been sent
+    get_flashed_messages()
+    return stream_template('orders.html', orders=iter_orders())
 
 @app.route('/login', methods=['GET', 'POST'])
+@limiter.limit('5 per minute', methods=['POST'])
 def login():
     if request.method == 'POST':
         email = request.form['email']
         password = request.form['password']
         user = User.query.filter_by(email=email).first()
-        if user and check_password_hash(user.password, password):
+        if user and verify_password(user, password):
             login_user(user)
             return redirect(url_for('home'))
         flash('Invalid credentials')
     return render_template('login.html')
 
 @app.route('/register', methods=['GET', 'POST'])
+@limiter.limit('10 per hour', methods=['POST'])
 def register():
     if request.method == 'POST':
         email = request.form['email']
-        password = generate_password_hash(request.form['password'])
+        password = password_hasher.hash(request.form['password'])
         name = request.form['name']
         address = request.form['address']
         if User.query.filter_by(email=email).first():
@@ -224,6 +590,7 @@ def profile():
         current_user.name = request.form.get('name', current_user.name)
         current_user.address = request.form.get('address', current_user.address)
         db.session.commit()
+        cache.delete(f'user:{current_user.id}')
         flash('Profile updated')
         return redirect(url_for('profile'))
     return render_template('profile.html')
@@ -257,7 +624,7 @@ if __name__ == '__main__':
                 Product(name='Adidas Originals Jacket', description='Cozy winter jacket', price=89.99, image='https://via.placeholder.com/300x200?text=Adidas+Jacket', category_id=2, stock=15),
                 Product(name='Keurig Coffee Maker', description='Single-serve coffee machine', price=149.99, image='https://via.placeholder.com/300x200?text=Coffee+Maker', category_id=3, stock=8),
                 Product(name='MacBook Pro 16\"', description='M3 Pro chip, 18GB RAM', price=2499.99, image='https://via.placeholder.com/300x200?text=MacBook', category_id=1, stock=3),
-                Product(name=\"Levi's 501 Jeans\", description='Original straight fit', price=69.99, image='https://via.placeholder.com/300x200?text=Levi%27s+Jeans', category_id=2, stock=25),
+                Product(name="Levi's 501 Jeans", description='Original straight fit', price=69.99, image='https://via.placeholder.com/300x200?text=Levi%27s+Jeans', category_id=2, stock=25),
                 Product(name='Lululemon Yoga Mat', description='Eco-friendly non-slip mat', price=29.99, image='https://via.placeholder.com/300x200?text=Yoga+Mat', category_id=4, stock=30)
             ]
             for prod in prods:
@@ -265,7 +632,7 @@ if __name__ == '__main__':
             db.session.commit()
 
         if not User.query.filter_by(email='demo@example.com').first():
-            user = User(email='demo@example.com', password=generate_password_hash('123456'), name='Demo User', address='123 Demo St, City')
+            user = User(email='demo@example.com', password=password_hasher.hash('123456'), name='Demo User', address='123 Demo St, City')
             db.session.add(user)
             db.session.commit()
 
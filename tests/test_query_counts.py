@@ -0,0 +1,126 @@
+import html
+import os
+import re
+import sys
+from contextlib import contextmanager
+
+os.environ['DATABASE_URL'] = 'sqlite://'
+os.environ['QUERY_COUNT_HEADER'] = '1'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+from sqlalchemy import event
+
+import app as shop
+
+# Enough rows that a lazy load per cart item, order or order item would blow the bounds below
+CART_ITEMS = 5
+ORDERS = 3
+
+
+@pytest.fixture
+def client():
+    shop.limiter.enabled = False
+    shop.cache.clear()
+    with shop.app.app_context():
+        shop.db.create_all()
+        shop.db.session.add_all([shop.Category(name='Electronics'), shop.Category(name='Home')])
+        shop.db.session.commit()
+        shop.db.session.add_all([
+            shop.Product(name=f'Product {i}', description='desc', price=10.0 + i, image='img',
+                         category_id=1 + i % 2, stock=100)
+            for i in range(12)
+        ])
+        shop.db.session.add(shop.User(email='demo@example.com', password=shop.password_hasher.hash('secret'),
+                                      name='Demo', address='1 Street'))
+        shop.db.session.commit()
+    client = shop.app.test_client()
+    client.post('/login', data={'email': 'demo@example.com', 'password': 'secret'})
+    yield client
+    with shop.app.app_context():
+        shop.db.drop_all()
+
+
+def fill_cart(client):
+    for product_id in range(1, CART_ITEMS + 1):
+        client.get(f'/add_to_cart/{product_id}')
+
+
+def place_orders(client):
+    for _ in range(ORDERS):
+        fill_cart(client)
+        page = client.get('/checkout').get_data(as_text=True)
+        token = page.split('name="checkout_token" value="')[1].split('"')[0]
+        client.post('/checkout', data={'checkout_token': token})
+
+
+@contextmanager
+def count_queries():
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    with shop.app.app_context():
+        engine = shop.db.engine
+    event.listen(engine, 'before_cursor_execute', record)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', record)
+
+
+def get_query_count(client, url):
+    # Read the body inside the counter: /orders is streamed and queries while rendering
+    with count_queries() as statements:
+        response = client.get(url)
+        response.get_data()
+    assert response.status_code == 200
+    return len(statements), response
+
+
+def test_home_query_count(client):
+    count, response = get_query_count(client, '/')
+    assert count <= 5
+    assert int(response.headers['X-Query-Count']) == count
+    # Catalog version, listing and categories are all served from cache now
+    count, _ = get_query_count(client, '/?page=2')
+    assert count <= 3
+
+
+def test_keyset_pages_share_count(client):
+    with shop.app.app_context():
+        shop.db.session.add_all([
+            shop.Product(name=f'Extra {i}', description='desc', price=30.0 + i, image='img', category_id=1)
+            for i in range(12)
+        ])
+        shop.db.session.commit()
+    url = '/'
+    for page in range(2, 5):
+        body = client.get(url).get_data(as_text=True)
+        url = '/' + html.unescape(re.search(r'href="([^"]*after_id[^"]*)"', body).group(1))
+        with count_queries() as statements:
+            client.get(url)
+        # The listing count is memoized per filter; only page 2 has to run it
+        assert sum('count(' in statement for statement in statements) == (1 if page == 2 else 0)
+
+
+def test_cart_query_count(client):
+    fill_cart(client)
+    count, response = get_query_count(client, '/cart')
+    assert count <= 3
+    assert int(response.headers['X-Query-Count']) == count
+
+
+def test_checkout_query_count(client):
+    fill_cart(client)
+    count, response = get_query_count(client, '/checkout')
+    assert count <= 3
+    assert int(response.headers['X-Query-Count']) == count
+
+
+def test_orders_query_count(client):
+    place_orders(client)
+    count, response = get_query_count(client, '/orders')
+    assert response.get_data(as_text=True).count('Order #') == ORDERS
+    assert count <= 4